@@ -19,7 +19,6 @@ if __name__ == "__main__":
         packages=["studip_api"],
         include_package_data=True,
         install_requires=[
-            "more_itertools",
             "attrs",
             "asyncio",
             "aiofiles",
@@ -1 +1,32 @@
 __version__ = "2.2"
+
+# the submodules are only imported once one of their attributes is accessed, so that `import studip_api` stays cheap
+_LAZY_ATTRIBUTES = {
+    "Semester": "studip_api.model",
+    "Course": "studip_api.model",
+    "File": "studip_api.model",
+    "Folder": "studip_api.model",
+    "ParserError": "studip_api.parsers",
+    "Download": "studip_api.downloader",
+    "ArchiveDownload": "studip_api.downloader",
+    "DownloadError": "studip_api.downloader",
+    "StudIPSession": "studip_api.session",
+    "StudIPError": "studip_api.session",
+    "LoginError": "studip_api.session",
+    "FolderWatcher": "studip_api.watcher",
+    "MetadataStore": "studip_api.store",
+    "BlobStore": "studip_api.blobstore",
+}
+
+
+def __getattr__(name):
+    if name not in _LAZY_ATTRIBUTES:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    import importlib
+    value = getattr(importlib.import_module(_LAZY_ATTRIBUTES[name]), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_LAZY_ATTRIBUTES))
@@ -0,0 +1,262 @@
+import asyncio
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+from typing import List, Optional
+
+import attr
+from cached_property import cached_property
+
+from studip_api.downloader import HASH_BLOCK_SIZE, ArchiveDownload, Download, file_digest, read_stored_digest, \
+    write_stored_digest
+from studip_api.model import File, Folder
+from studip_api.session import StudIPSession
+
+log = logging.getLogger("studip_api.BlobStore")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS blobs (
+    digest TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    changed REAL,
+    first_block BLOB NOT NULL,
+    last_block BLOB NOT NULL,
+    PRIMARY KEY (digest, name, changed)
+);
+CREATE INDEX IF NOT EXISTS blobs_size_name ON blobs(size, name);
+CREATE INDEX IF NOT EXISTS blobs_size_changed ON blobs(size, changed);
+"""
+
+FICLONE = 0x40049409  # from linux/fs.h
+HARDLINK_UNSUPPORTED = (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP)
+
+
+def link_blob(blob_path: str, local_path: str, allow_hardlinks: bool = True, replace: bool = True):
+    # prefer reflinks, so that the copies keep their own timestamps, and fall back to hardlinks and plain copies
+    # with replace=False, FileExistsError is raised if local_path was created concurrently
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(local_path), prefix=".", suffix=".blob")
+    os.close(fd)
+    try:
+        method = None
+        try:
+            with open(blob_path, "rb") as src, open(tmp_path, "wb") as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            method = "reflink"
+        except OSError:
+            pass
+
+        if not method and allow_hardlinks:
+            os.unlink(tmp_path)
+            try:
+                os.link(blob_path, tmp_path)
+                method = "hardlink"
+            except OSError as e:
+                if e.errno not in HARDLINK_UNSUPPORTED:
+                    raise
+
+        if not method:
+            shutil.copyfile(blob_path, tmp_path)
+            method = "copy"
+
+        if replace:
+            os.replace(tmp_path, local_path)
+        else:
+            _rename_exclusive(tmp_path, local_path)
+        return method
+    finally:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+
+
+def _rename_exclusive(tmp_path: str, path: str):
+    try:
+        os.link(tmp_path, path)
+    except OSError as e:
+        if e.errno not in HARDLINK_UNSUPPORTED:
+            raise
+        # can't create the file atomically without hardlinks, so fall back to replacing it
+        os.replace(tmp_path, path)
+
+
+@attr.s(hash=False)
+class BlobStore(object):
+    # Where the filesystem doesn't support reflinks, all copies of a blob are hardlinks sharing a single inode and
+    # thus also a single mtime, which is the changed timestamp of the copy that was linked last. Disable
+    # allow_hardlinks to fall back to plain copies instead, which keep their own timestamps but use more space.
+    # With sample_duplicates enabled, a likely duplicate is only confirmed by comparing the first and last block
+    # instead of the digest of the whole file. This saves downloading it, but files that only differ in between
+    # are linked to the wrong content. It doesn't apply to download_folder_contents, where all files are
+    # contained in one archive.
+    session = attr.ib()  # type: StudIPSession
+    root = attr.ib()  # type: str
+    allow_hardlinks = attr.ib(default=True)  # type: bool
+    sample_duplicates = attr.ib(default=False)  # type: bool
+
+    @property
+    def blob_dir(self):
+        return os.path.join(self.root, ".blobs")
+
+    def blob_path(self, digest: str):
+        return os.path.join(self.blob_dir, digest[:2], digest)
+
+    @cached_property
+    def connection(self) -> sqlite3.Connection:
+        # only used from the event loop thread, file operations run in the executor without touching the index
+        os.makedirs(self.blob_dir, exist_ok=True)
+        connection = sqlite3.connect(os.path.join(self.blob_dir, "index.sqlite"))
+        connection.executescript(SCHEMA)
+        return connection
+
+    def close(self):
+        if "connection" in self.__dict__:
+            self.connection.close()
+            del self.__dict__["connection"]
+
+    async def download_file_contents(self, studip_file: File, local_dest: str,
+                                     chunk_size: int = 1024 * 64) -> Download:
+        digest = await self.find_duplicate(studip_file) if self.sample_duplicates else None
+        if digest:
+            log.info("Linking %s -> %s to duplicate blob %s", studip_file, local_dest, digest)
+            # noinspection PyProtectedMember
+            await self.session._loop.run_in_executor(None, self._link, digest, local_dest)
+            await self.session._set_timestamp(studip_file, local_dest)
+            download = Download(self.session.ahttp, self.session._get_download_url(studip_file), local_dest,
+                                chunk_size, size=studip_file.size)
+            await download.load_completed()
+            return download
+
+        download = await self.session.download_file_contents(studip_file, local_dest, chunk_size)
+        old_completed_future = download.completed
+
+        async def await_completed():
+            ranges = await old_completed_future
+            last_index = max(0, (download.total_length - 1) // HASH_BLOCK_SIZE)
+            await self._store_and_index(studip_file, local_dest, download.digest, download.total_length,
+                                        download.block_digests.get(0, b""), download.block_digests.get(last_index, b""))
+            return ranges
+
+        download.completed = asyncio.ensure_future(await_completed())
+        return download
+
+    async def download_folder_contents(self, folder: Folder, local_dest: str, selection: List[File] = None,
+                                       chunk_size: int = 1024 * 64) -> ArchiveDownload:
+        download = await self.session.download_folder_contents(folder, local_dest, selection, chunk_size)
+        old_completed_future = download.completed
+
+        async def await_completed():
+            extracted = await old_completed_future
+            # noinspection PyProtectedMember
+            loop = self.session._loop
+            for name in extracted:
+                local_path = download.members[name]
+                digest, size, first_block, last_block = \
+                    await loop.run_in_executor(None, self._read_file_digests, local_path)
+                await self._store_and_index(download.files[name], local_path, digest, size, first_block, last_block)
+
+            files_by_path = {download.members[name]: f for name, f in download.files.items()}
+            for fallback in download.fallbacks:
+                last_index = max(0, (fallback.total_length - 1) // HASH_BLOCK_SIZE)
+                await self._store_and_index(
+                    files_by_path[fallback.local_path], fallback.local_path, fallback.digest, fallback.total_length,
+                    fallback.block_digests.get(0, b""), fallback.block_digests.get(last_index, b""))
+            return extracted
+
+        download.completed = asyncio.ensure_future(await_completed())
+        return download
+
+    async def _store_and_index(self, studip_file: File, local_path: str, digest: str, size: int,
+                               first_block: bytes, last_block: bytes):
+        # noinspection PyProtectedMember
+        await self.session._loop.run_in_executor(None, self._store, local_path, digest)
+        self._index(studip_file, digest, size, first_block, last_block)
+        log.debug("Stored %s as blob %s", local_path, digest)
+        # linking may have replaced the file or changed the shared mtime of a hardlinked blob
+        # noinspection PyProtectedMember
+        await self.session._set_timestamp(studip_file, local_path)
+
+    @staticmethod
+    def _read_file_digests(local_path: str):
+        digest = read_stored_digest(local_path) or file_digest(local_path)
+        size = os.path.getsize(local_path)
+        last_index = max(0, (size - 1) // HASH_BLOCK_SIZE)
+        with open(local_path, "rb") as f:
+            first_block = hashlib.sha256(f.read(HASH_BLOCK_SIZE)).digest()
+            f.seek(last_index * HASH_BLOCK_SIZE)
+            last_block = hashlib.sha256(f.read(HASH_BLOCK_SIZE)).digest()
+        return digest, size, first_block, last_block
+
+    async def find_duplicate(self, studip_file: File) -> Optional[str]:
+        if not studip_file.size:
+            return None
+        changed = studip_file.changed.timestamp() if studip_file.changed else None
+        candidates = self.connection.execute(
+            "SELECT digest, first_block, last_block FROM blobs WHERE size = ? AND (name = ? OR changed = ?) "
+            "ORDER BY name = ? AND changed = ? DESC",
+            (studip_file.size, studip_file.name, changed, studip_file.name, changed)).fetchall()
+        candidates = [c for c in candidates if os.path.isfile(self.blob_path(c[0]))]
+        if not candidates:
+            return None
+
+        # heuristically confirm the guess by hashing the first and last block of the file on Stud.IP
+        # noinspection PyProtectedMember
+        url = self.session._get_download_url(studip_file)
+        last_index = (studip_file.size - 1) // HASH_BLOCK_SIZE
+        first_block = await self._fetch_block_digest(url, 0, studip_file.size)
+        last_block = await self._fetch_block_digest(url, last_index, studip_file.size) \
+            if last_index > 0 else first_block
+        if first_block is None or last_block is None:
+            return None
+        for digest, candidate_first_block, candidate_last_block in candidates:
+            if candidate_first_block == first_block and candidate_last_block == last_block:
+                return digest
+        log.debug("Blocks of %s don't match any of the %s candidate blobs", studip_file, len(candidates))
+        return None
+
+    async def _fetch_block_digest(self, url, index, size):
+        start = index * HASH_BLOCK_SIZE
+        stop = min(start + HASH_BLOCK_SIZE, size)
+        async with self.session.ahttp.get(url, headers={"Range": "bytes=%s-%s" % (start, stop - 1)}) as resp:
+            if resp.status != 206:
+                # don't read the whole file if the server ignores the range
+                log.debug("Server answered range request for block %s of %s with status %s", index, url, resp.status)
+                return None
+            data = b""
+            while len(data) < stop - start:
+                chunk = await resp.content.read(stop - start - len(data))
+                if not chunk:
+                    return None
+                data += chunk
+        return hashlib.sha256(data).digest()
+
+    def _link(self, digest, local_dest):
+        link_blob(self.blob_path(digest), local_dest, self.allow_hardlinks)
+        write_stored_digest(local_dest, digest)
+
+    def _store(self, local_path: str, digest: str):
+        blob_path = self.blob_path(digest)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        if not os.path.isfile(blob_path):
+            try:
+                link_blob(local_path, blob_path, self.allow_hardlinks, replace=False)
+                return
+            except FileExistsError:
+                # another download of the same content created the blob concurrently
+                pass
+        # the same content was downloaded before, so only keep one copy
+        link_blob(blob_path, local_path, self.allow_hardlinks)
+
+    def _index(self, studip_file: File, digest: str, size: int, first_block: bytes, last_block: bytes):
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO blobs (digest, size, name, changed, first_block, last_block) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (digest, size, studip_file.name, studip_file.changed.timestamp() if studip_file.changed else None,
+                 first_block, last_block))
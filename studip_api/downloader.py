@@ -1,37 +1,112 @@
 import asyncio
+import hashlib
 import logging
 import os
 import re
-from typing import List, Tuple
+import tempfile
+import zipfile
+from typing import TYPE_CHECKING, Any, Dict, List, Tuple
 
-import aiofiles
-import aiohttp
 import attr
-import more_itertools
-from aiofiles.threadpool import AsyncFileIO
 from cached_property import cached_property
 
+if TYPE_CHECKING:
+    import aiohttp
+    from aiofiles.threadpool import AsyncFileIO
+
 log = logging.getLogger("studip_api.Download")
+log_archive = logging.getLogger("studip_api.ArchiveDownload")
 log_downloading = logging.getLogger("studip_api.Download.progress")
 
+# Files are hashed as a two-level tree: the SHA-256 of the concatenated SHA-256 digests of all HASH_BLOCK_SIZE blocks.
+# This allows ranges downloaded in parallel to be hashed independently, as long as they start at a block boundary.
+HASH_BLOCK_SIZE = 1024 * 64
+DIGEST_SUFFIX = ".sha256tree"
+
+
+class RangeHasher(object):
+    def __init__(self, byte_range: range, blocks: Dict[int, bytes]):
+        assert byte_range.start % HASH_BLOCK_SIZE == 0, "Range %s doesn't start at a hash block boundary" % byte_range
+        self.offset = byte_range.start
+        self.stop = byte_range.stop
+        self.blocks = blocks
+        self.hash = hashlib.sha256()
+
+    def update(self, data):
+        data = memoryview(data)[:max(0, self.stop - self.offset)]
+        while data:
+            part = data[:HASH_BLOCK_SIZE - self.offset % HASH_BLOCK_SIZE]
+            self.hash.update(part)
+            self.offset += len(part)
+            data = data[len(part):]
+            if self.offset % HASH_BLOCK_SIZE == 0 or self.offset == self.stop:
+                self.blocks[(self.offset - 1) // HASH_BLOCK_SIZE] = self.hash.digest()
+                self.hash = hashlib.sha256()
+
+
+def combine_block_digests(blocks: Dict[int, bytes], total_length: int) -> str:
+    count = -(-total_length // HASH_BLOCK_SIZE)
+    assert len(blocks) == count, "Expected %s hashed blocks, but got %s" % (count, len(blocks))
+    return hashlib.sha256(b"".join(blocks[i] for i in range(count))).hexdigest()
+
+
+def file_digest(path: str) -> str:
+    blocks = {}
+    with open(path, "rb") as f:
+        hasher = RangeHasher(range(0, os.fstat(f.fileno()).st_size), blocks)
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            hasher.update(block)
+        return combine_block_digests(blocks, hasher.stop)
+
+
+def read_stored_digest(path: str):
+    try:
+        with open(path + DIGEST_SUFFIX, "r") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def write_stored_digest(path: str, digest: str):
+    with open(path + DIGEST_SUFFIX, "w") as f:
+        f.write(digest + "\n")
+
+
+class DownloadError(Exception):
+    pass
+
 
 @attr.s()
 class Download(object):
     ahttp = attr.ib()  # type: aiohttp.ClientSession
     url = attr.ib()  # type: str
     local_path = attr.ib()  # type: str
-    chunk_size = attr.ib(default=1024 * 256)  # type: int
+    chunk_size = attr.ib(default=HASH_BLOCK_SIZE)  # type: int
+    size = attr.ib(default=None)  # type: int
+    max_chunk_size = attr.ib(default=1024 * 1024 * 16)  # type: int
+    target_duration = attr.ib(default=2)  # type: float
+    parallel = attr.ib(default=4)  # type: int
 
     total_length = attr.ib(init=False, default=-1)  # type: int
+    scheduled = attr.ib(init=False, default=0)  # type: int
+    stopped = attr.ib(init=False, default=False)  # type: bool
+    failed = attr.ib(init=False, default=False)  # type: bool
+    throughput = attr.ib(init=False, default=None)  # type: float
     aiofile = attr.ib(init=False, default=None)  # type: AsyncFileIO
     parts = attr.ib(init=False, default=None)  # type: List[Tuple[range, asyncio.Future[range]]]
     completed = attr.ib(init=False, default=None)  # type: asyncio.Future[List[range]]
+    block_digests = attr.ib(init=False, default=None)  # type: Dict[int, bytes]
+    digest = attr.ib(init=False, default=None)  # type: str
 
     @cached_property
     def write_lock(self) -> asyncio.Lock:
         # initialize lazy, so that asyncio.get_event_loop() doesn't create a new event loop before the actual one is set
         return asyncio.Lock()
 
+    @cached_property
+    def scheduled_condition(self) -> asyncio.Condition:
+        return asyncio.Condition()
+
     # noinspection PyProtectedMember
     @property
     def oiofile(self):
@@ -52,7 +127,8 @@ class Download(object):
         return self.aiofile._executor
 
     async def load_completed(self):
-        self.total_length = await self.fetch_total_length()
+        import aiofiles
+        self.total_length = self.size if self.size is not None else await self.fetch_total_length()
         async with aiofiles.open(self.local_path, "rb", buffering=0) as self.aiofile:
             async with self.write_lock:
                 old_file_position = await self.aiofile.tell()
@@ -67,36 +143,98 @@ class Download(object):
             full_range_future = self.loop.create_future()
             full_range_future.set_result(full_range)
             self.parts = [(full_range, full_range_future)]
+            self.scheduled = self.total_length
             self.completed = self.loop.create_future()
             self.completed.set_result(full_range)
+        self.digest = await self.loop.run_in_executor(None, read_stored_digest, self.local_path)
 
         log.debug("Loaded completed download %s containing %s bytes", self.local_path, self.total_length)
 
     async def start(self):
-        self.total_length = await self.fetch_total_length()
+        import aiofiles
+        # if the size is already known from the file listing, the HEAD request can be skipped
+        self.total_length = self.size if self.size is not None else await self.fetch_total_length()
 
+        if self.chunk_size % HASH_BLOCK_SIZE:
+            self.chunk_size += HASH_BLOCK_SIZE - self.chunk_size % HASH_BLOCK_SIZE
+            log.debug("Rounded chunk size up to %s bytes to align ranges with hash blocks", self.chunk_size)
+
+        self.block_digests = {}
+        self.parts = []
+        if os.path.lexists(self.local_path):
+            # replace instead of truncating in place, as the old file may be hardlinked to a blob of a BlobStore
+            os.unlink(self.local_path)
         self.aiofile = await aiofiles.open(self.local_path, "wb", buffering=0)
         try:
             await self.aiofile.truncate(self.total_length)
-            ranges = list(more_itertools.sliced(range(self.total_length), self.chunk_size))
-            self.parts = [(r, asyncio.ensure_future(self.download_range(r))) for r in ranges]
-            log.debug("Started download of %s, expecting %s bytes split into %s parts",
-                      self.local_path, self.total_length, len(self.parts))
+            workers = [asyncio.ensure_future(self._download_ranges()) for _ in range(self.parallel)]
+            log.debug("Started download of %s, expecting %s bytes using %s parallel requests",
+                      self.local_path, self.total_length, self.parallel)
         except:
             self.aiofile.close()
             raise
 
         async def await_completed():
             try:
+                await asyncio.gather(*workers)
                 completed_ranges = await asyncio.gather(*(f for r, f in self.parts))
                 log.debug("Finished download of %s, expecting %s bytes split into %s parts",
                           self.local_path, self.total_length, len(self.parts))
+                self.digest = combine_block_digests(self.block_digests, self.total_length)
+                await self.loop.run_in_executor(None, write_stored_digest, self.local_path, self.digest)
                 return completed_ranges
             finally:
                 await self.aiofile.close()
+                self.stopped = True
+                async with self.scheduled_condition:
+                    self.scheduled_condition.notify_all()
 
         self.completed = asyncio.ensure_future(await_completed())
 
+    async def _download_ranges(self):
+        # ranges are scheduled in order, so self.parts always covers range(0, self.scheduled)
+        while self.scheduled < self.total_length and not self.failed:
+            byte_range = range(self.scheduled, min(self.scheduled + self._next_range_size(), self.total_length))
+            future = self.loop.create_future()
+            self.parts.append((byte_range, future))
+            self.scheduled = byte_range.stop
+            async with self.scheduled_condition:
+                self.scheduled_condition.notify_all()
+
+            start_time = self.loop.time()
+            try:
+                completed_range = await self.download_range(byte_range)
+            except Exception as e:
+                # the download can't complete anymore, so don't let the other workers schedule further ranges
+                self.failed = True
+                future.set_exception(e)
+                return
+            future.set_result(completed_range)
+            self._update_throughput(len(completed_range), self.loop.time() - start_time)
+
+    def _update_throughput(self, length, duration):
+        if duration <= 0:
+            return
+        throughput = length / duration
+        if self.throughput is None:
+            self.throughput = throughput
+        else:
+            self.throughput = (self.throughput + throughput) / 2
+
+    def _next_range_size(self):
+        # start with small ranges for a fast first response and grow them until a request takes target_duration
+        if not self.parts:
+            size = self.chunk_size
+        elif self.throughput is None:
+            size = len(self.parts[-1][0])
+        else:
+            size = min(len(self.parts[-1][0]) * 2, self.throughput * self.target_duration, self.max_chunk_size)
+            size = max(self.chunk_size, int(size) // HASH_BLOCK_SIZE * HASH_BLOCK_SIZE)
+        if self.total_length - (self.scheduled + size) < size // 2:
+            # don't leave a tiny range at the end of the file
+            size = self.total_length - self.scheduled
+        return size
+
     async def fetch_total_length(self):
         async with self.ahttp.head(self.url) as r:
             accept_ranges = r.headers.get("Accept-Ranges", "")
@@ -115,10 +253,18 @@ class Download(object):
         return total_length
 
     async def download_range(self, byte_range):
-        async with self.ahttp.get(self.url, headers={
-            "Range": "bytes={0}-{1}".format(byte_range.start, byte_range.stop)
-        }) as resp:
-            actual_range = self._extract_range(resp, byte_range)
+        whole_file = len(byte_range) == self.total_length
+        headers = {} if whole_file else {"Range": "bytes={0}-{1}".format(byte_range.start, byte_range.stop)}
+        async with self.ahttp.get(self.url, headers=headers) as resp:
+            if whole_file:
+                if resp.content_length is not None and resp.content_length != self.total_length:
+                    raise DownloadError("Expected %s to contain %s bytes, but server sent %s bytes. "
+                                        "The file may have changed since it was listed." %
+                                        (self.url, self.total_length, resp.content_length))
+                actual_range = "bytes */%s" % self.total_length
+            else:
+                actual_range = self._extract_range(resp, byte_range)
+            hasher = RangeHasher(byte_range, self.block_digests)
 
             offset = byte_range.start
             while True:
@@ -127,11 +273,15 @@ class Download(object):
                     break
                 log_downloading.debug("Chunk %s: writing at offset %6d + %6d new bytes = %6d new offset. Data: %s...%s",
                                       actual_range, offset, len(chunk), offset + len(chunk), chunk[:10], chunk[-10:])
+                hasher.update(chunk)
                 written = await self._write_chunk(chunk, offset)
                 offset += written
 
         await self.aiofile.flush()
         log_downloading.debug("Chunk %s: wrote bytes from %6d to %6d", actual_range, byte_range.start, offset)
+        if offset < byte_range.stop or (whole_file and offset != self.total_length):
+            raise DownloadError("Expected bytes %s-%s of %s, but only received bytes up to %s" %
+                                (byte_range.start, byte_range.stop, self.url, offset))
         return range(byte_range.start, offset)
 
     def _extract_range(self, resp, expected_byte_range):
@@ -141,6 +291,14 @@ class Download(object):
         expected_range_plus1 = "bytes %s-%s/%s" % \
                                (expected_byte_range.start, expected_byte_range.stop, self.total_length)
         actual_range = resp.headers.get("Content-Range", "")
+        match = re.match("bytes ([0-9]*)-([0-9]*)/([0-9]*)", actual_range)
+        if resp.status != 206 or not match or int(match.group(1)) != expected_byte_range.start:
+            raise DownloadError("Requested range %s of %s, but server answered with status %s and range '%s'" %
+                                (requested_rage, self.url, resp.status, actual_range))
+        if int(match.group(3)) != self.total_length:
+            raise DownloadError("Expected %s to contain %s bytes, but server reported %s bytes. "
+                                "The file may have changed since it was listed." %
+                                (self.url, self.total_length, match.group(3)))
         if expected_range != actual_range and expected_range_plus1 != actual_range:
             log.warning("Requested range %s, expected %s, got %s",
                         requested_rage, expected_range, actual_range)
@@ -178,6 +336,13 @@ class Download(object):
             return
 
         requested_range = range(offset, min(offset + length, self.total_length))
+        async with self.scheduled_condition:
+            await self.scheduled_condition.wait_for(
+                lambda: self.scheduled >= requested_range.stop or self.stopped)
+        if self.scheduled < requested_range.stop:
+            # the download stopped before reaching the requested range, so rethrow its exception
+            await self.completed
+
         completed_ranges = []
         for r, f in self.parts:
             if max(requested_range.start, r.start) < min(requested_range.stop, r.stop):
@@ -192,3 +357,89 @@ class Download(object):
                                                (first, last, requested_range)
         assert last >= requested_range.stop, "Completed range(%s, %s) doesn't cover requested %s" % \
                                              (first, last, requested_range)
+
+
+@attr.s()
+class ArchiveDownload(object):
+    ahttp = attr.ib()  # type: aiohttp.ClientSession
+    url = attr.ib()  # type: str
+    data = attr.ib()  # type: List[Tuple[str, str]]
+    members = attr.ib()  # type: Dict[str, str]
+    chunk_size = attr.ib(default=HASH_BLOCK_SIZE)  # type: int
+
+    extracted = attr.ib(init=False, default=None)  # type: List[str]
+    fallbacks = attr.ib(init=False, default=None)  # type: List[Download]
+    files = attr.ib(init=False, default=None)  # type: Dict[str, Any]
+    completed = attr.ib(init=False, default=None)  # type: asyncio.Future[List[str]]
+
+    async def start(self):
+        self.completed = asyncio.ensure_future(self.download())
+
+    async def download(self):
+        loop = asyncio.get_event_loop()
+        with tempfile.TemporaryFile() as tmp:
+            async with self.ahttp.post(self.url, data=self.data) as resp:
+                content_type = resp.headers.get("Content-Type", "")
+                if resp.status != 200 or "zip" not in content_type:
+                    log_archive.warning("Stud.IP refused to create archive for %s, got status %s with type '%s'",
+                                        self.url, resp.status, content_type)
+                    self.extracted = []
+                    return self.extracted
+
+                length = 0
+                while True:
+                    chunk = await resp.content.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    await loop.run_in_executor(None, tmp.write, chunk)
+                    length += len(chunk)
+                log_archive.debug("Received archive for %s containing %s bytes", self.url, length)
+
+            self.extracted = await loop.run_in_executor(None, self._blocking_extract, tmp)
+
+        log_archive.debug("Extracted %s of %s expected files from %s",
+                          len(self.extracted), len(self.members), self.url)
+        return self.extracted
+
+    def _blocking_extract(self, fileobj):
+        fileobj.seek(0)
+        extracted = []
+        try:
+            archive = zipfile.ZipFile(fileobj)
+        except zipfile.BadZipFile:
+            log_archive.warning("Stud.IP sent an invalid archive for %s", self.url, exc_info=True)
+            return extracted
+
+        with archive:
+            for info in archive.infolist():
+                name = self._member_name(info)
+                if name not in self.members:
+                    if not name.endswith("/"):
+                        log_archive.debug("Ignoring unexpected archive member %s", name)
+                    continue
+
+                local_path = self.members[name]
+                os.makedirs(os.path.dirname(local_path), exist_ok=True)
+                blocks = {}
+                hasher = RangeHasher(range(0, info.file_size), blocks)
+                # extract to a temporary file, so that a file hardlinked to a blob of a BlobStore isn't overwritten
+                tmp_path = local_path + ".part"
+                with archive.open(info) as src, open(tmp_path, "wb") as dst:
+                    for chunk in iter(lambda: src.read(self.chunk_size), b""):
+                        hasher.update(chunk)
+                        dst.write(chunk)
+                os.replace(tmp_path, local_path)
+                write_stored_digest(local_path, combine_block_digests(blocks, info.file_size))
+                extracted.append(name)
+        return extracted
+
+    @staticmethod
+    def _member_name(info: zipfile.ZipInfo):
+        name = info.filename
+        if not info.flag_bits & 0x800:
+            # PHP's ZipArchive stores UTF-8 names without setting the UTF-8 flag, so zipfile decoded them as cp437
+            try:
+                name = name.encode("cp437").decode("utf-8")
+            except UnicodeError:
+                pass
+        return name.lstrip("/")
@@ -5,7 +5,6 @@ from datetime import datetime
 from typing import Optional
 
 import attr
-from bs4 import BeautifulSoup
 
 from studip_api.model import Course, File, Folder, Semester
 
@@ -17,6 +16,12 @@ COURSE_NAME_TYPE_RE = re.compile(r'(.*?)\s*\(\s*([^)]+)\s*\)\s*$')
 DATE_FORMATS = ['%d.%m.%Y %H:%M:%S', '%d/%m/%y %H:%M:%S']
 
 
+def make_soup(html):
+    # BeautifulSoup and lxml take most of the import time, so only load them once the first page is parsed
+    from bs4 import BeautifulSoup
+    return BeautifulSoup(html, 'lxml')
+
+
 def compact(str):
     return " ".join(str.split())
 
@@ -57,7 +62,7 @@ class ParserError(Exception):
 
 
 def parse_login_form(html):
-    soup = BeautifulSoup(html, 'lxml')
+    soup = make_soup(html)
 
     for form in soup.find_all('form'):
         if 'action' in form.attrs:
@@ -66,7 +71,7 @@ def parse_login_form(html):
 
 
 def parse_saml_form(html):
-    soup = BeautifulSoup(html, 'lxml')
+    soup = make_soup(html)
     saml_fields = ['RelayState', 'SAMLResponse']
     form_data = {}
     p = soup.find('p')
@@ -80,7 +85,7 @@ def parse_saml_form(html):
 
 
 def parse_user_selection(html):
-    soup = BeautifulSoup(html, 'lxml')
+    soup = make_soup(html)
 
     selected_semester = soup.find('select', {'name': 'sem_select'}).find('option', {'selected': True})
     if not selected_semester:
@@ -96,7 +101,7 @@ def parse_user_selection(html):
 
 
 def parse_semester_list(html):
-    soup = BeautifulSoup(html, 'lxml')
+    soup = make_soup(html)
 
     for item in soup.find_all('select', {'name': 'sem_select'}):
         options = item.find('optgroup').find_all('option')
@@ -107,7 +112,7 @@ def parse_semester_list(html):
 
 
 def parse_course_list(html, semester: Semester):
-    soup = BeautifulSoup(html, 'lxml')
+    soup = make_soup(html)
     current_number = semester_str = None
     invalid_semester = found_course = False
 
@@ -151,7 +156,7 @@ def parse_course_list(html, semester: Semester):
 
 
 def parse_file_list_index(html, course: Course, folder_info: Optional[Folder]):
-    soup = BeautifulSoup(html, 'lxml')
+    soup = make_soup(html)
     table = soup.find("table", class_="documents")
     if not table:
         msg = "Couldn't find document table. "
@@ -213,6 +218,14 @@ def parse_file_list_index(html, course: Course, folder_info: Optional[Folder]):
     return folder
 
 
+def parse_security_token(html):
+    soup = make_soup(html)
+    token = soup.find("input", {"name": "security_token"})
+    if not token or not token.attrs.get("value"):
+        raise ParserError("Could not find security token", soup)
+    return token.attrs["value"]
+
+
 def parse_file_details(html, file):
     warnings.warn("Not implemented")
     return file
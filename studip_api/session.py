@@ -2,15 +2,16 @@ import asyncio
 import logging
 import os
 import time
-from typing import List
+from typing import List, Tuple
 from urllib.parse import urlencode
 from weakref import WeakSet
 
-import aiohttp
-from aiohttp import ClientError
+import attr
 
-from studip_api.downloader import Download
-from studip_api.parsers import *
+from studip_api.downloader import ArchiveDownload, Download
+from studip_api.model import Course, File, Folder, Semester
+from studip_api.parsers import ParserError, parse_course_list, parse_file_details, parse_file_list_index, \
+    parse_login_form, parse_saml_form, parse_security_token, parse_semester_list, parse_user_selection
 
 log = logging.getLogger("studip_api.StudIPSession")
 
@@ -34,11 +35,13 @@ class StudIPSession:
         self._user_selected_semester = None  # type: Semester
         self._user_selected_ansicht = None  # type: str
         self._needs_reset_at = False  # type: int
+        self._security_token = None  # type: str
         self._semester_select_lock = asyncio.Lock()
         self._background_tasks = WeakSet()  # TODO better management of (failing of) background tasks
         if not self._loop:
             self._loop = asyncio.get_event_loop()
 
+        import aiohttp
         http_args = dict(self._http_args)
         connector = aiohttp.TCPConnector(loop=self._loop, limit=http_args.pop("limit"),
                                          keepalive_timeout=http_args.pop("keepalive_timeout"),
@@ -65,6 +68,7 @@ class StudIPSession:
         return self._studip_base + url
 
     async def do_login(self, user_name, password):
+        from aiohttp import ClientError
         try:
             async with self.ahttp.get(self._studip_url("/studip/index.php?again=yes&sso=shib")) as r:
                 post_url = parse_login_form(await r.text())
@@ -163,14 +167,25 @@ class StudIPSession:
 
     async def get_course_files(self, course: Course) -> Folder:
         async with self.ahttp.get(self._studip_url("/studip/dispatch.php/course/files/index?cid=" + course.id)) as r:
+            self._update_security_token(await r.text())
             return parse_file_list_index(await r.text(), course, None)
 
     async def get_folder_files(self, folder: Folder) -> Folder:
         async with self.ahttp.get(
                 self._studip_url("/studip/dispatch.php/course/files/index/%s?cid=%s" % (folder.id, folder.course.id))
         ) as r:
+            self._update_security_token(await r.text())
             return parse_file_list_index(await r.text(), folder.course, folder)
 
+    def _update_security_token(self, html):
+        # the CSRF token is the same for all forms of the session, so only parse it from the first files page
+        if self._security_token:
+            return
+        try:
+            self._security_token = parse_security_token(html)
+        except ParserError:
+            log.warning("Could not find security token on files page", exc_info=True)
+
     async def get_file_info(self, file: File) -> File:
         async with self.ahttp.get(
                 self._studip_url("/studip/dispatch.php/file/details/%s?cid=%s" % (file.id, file.course.id))
@@ -178,9 +193,10 @@ class StudIPSession:
             return parse_file_details(await r.text(), file)
 
     async def download_file_contents(self, studip_file: File, local_dest: str = None,
-                                     chunk_size: int = 1024 * 256) -> Download:
+                                     chunk_size: int = 1024 * 64) -> Download:
         log.info("Starting download %s -> %s", studip_file, local_dest)
-        download = Download(self.ahttp, self._get_download_url(studip_file), local_dest, chunk_size)
+        download = Download(self.ahttp, self._get_download_url(studip_file), local_dest, chunk_size,
+                            size=studip_file.size)
         await download.start()
         old_completed_future = download.completed
 
@@ -194,18 +210,73 @@ class StudIPSession:
                 val = r.stop
             assert val == download.total_length
 
-            if studip_file.changed:
-                timestamp = time.mktime(studip_file.changed.timetuple())
-                await self._loop.run_in_executor(None, os.utime, local_dest, (timestamp, timestamp))
-            else:
-                log.warning("Can't set timestamp of file %s :: %s, because the value wasn't loaded from Stud.IP",
-                            studip_file, local_dest)
-
+            await self._set_timestamp(studip_file, local_dest)
             return ranges
 
         download.completed = asyncio.ensure_future(await_completed())
         return download
 
+    async def download_folder_contents(self, folder: Folder, local_dest: str, selection: List[File] = None,
+                                       chunk_size: int = 1024 * 64) -> ArchiveDownload:
+        # files missing from the archive are downloaded separately, see ArchiveDownload.fallbacks
+        if folder.contents is None or not self._security_token:
+            folder = await self.get_folder_files(folder)
+        if selection is None:
+            selection = folder.contents
+        assert all(f.parent.id == folder.id for f in selection), "Can only download direct children of %s" % folder
+
+        files = await self._collect_archive_files(selection, [])
+        members = {"/".join(path): os.path.join(local_dest, *path) for path, f in files}
+        log.info("Starting archive download of %s files from %s -> %s", len(files), folder, local_dest)
+        download = ArchiveDownload(
+            self.ahttp, self._studip_url("/studip/dispatch.php/file/bulk/%s?cid=%s" % (folder.id, folder.course.id)),
+            ([("security_token", self._security_token)] if self._security_token else [])
+            + [("ids[]", f.id) for f in selection] + [("download", "1")], members, chunk_size)
+        download.files = {"/".join(path): f for path, f in files}
+        await download.start()
+        old_completed_future = download.completed
+
+        async def await_completed():
+            extracted = set(await old_completed_future)
+            download.fallbacks = []
+            for path, studip_file in files:
+                local_path = members["/".join(path)]
+                if "/".join(path) in extracted:
+                    await self._set_timestamp(studip_file, local_path)
+                else:
+                    log.debug("File %s is missing from archive, downloading it separately", studip_file)
+                    os.makedirs(os.path.dirname(local_path), exist_ok=True)
+                    download.fallbacks.append(await self.download_file_contents(studip_file, local_path, chunk_size))
+            if files and len(download.fallbacks) == len(files):
+                log.warning("Stud.IP didn't deliver any of the %s files from %s as archive, "
+                            "downloaded all of them separately", len(files), folder)
+            await asyncio.gather(*(d.completed for d in download.fallbacks))
+            log.info("Completed archive download of %s files (%s separately) from %s -> %s",
+                     len(files), len(download.fallbacks), folder, local_dest)
+            return download.extracted
+
+        download.completed = asyncio.ensure_future(await_completed())
+        return download
+
+    async def _collect_archive_files(self, selection: List[File], path: List[str]) -> List[Tuple[List[str], File]]:
+        files = []
+        for f in selection:
+            if f.is_folder():
+                if f.contents is None:
+                    f = await self.get_folder_files(f)
+                files.extend(await self._collect_archive_files(f.contents, path + [f.name]))
+            else:
+                files.append((path + [f.name], f))
+        return files
+
+    async def _set_timestamp(self, studip_file: File, local_dest: str):
+        if studip_file.changed:
+            timestamp = time.mktime(studip_file.changed.timetuple())
+            await self._loop.run_in_executor(None, os.utime, local_dest, (timestamp, timestamp))
+        else:
+            log.warning("Can't set timestamp of file %s :: %s, because the value wasn't loaded from Stud.IP",
+                        studip_file, local_dest)
+
     def _get_download_url(self, studip_file):
         return self._studip_url("/studip/sendfile.php?force_download=1&type=0&"
                                 + urlencode({"file_id": studip_file.id, "file_name": studip_file.name}))
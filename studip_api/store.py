@@ -0,0 +1,252 @@
+import logging
+import sqlite3
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional
+
+import attr
+from cached_property import cached_property
+
+from studip_api.model import Course, File, Folder, Semester
+
+log = logging.getLogger("studip_api.MetadataStore")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS semesters (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    "order" INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS courses (
+    id TEXT PRIMARY KEY,
+    semester_id TEXT NOT NULL REFERENCES semesters(id),
+    number TEXT,
+    name TEXT NOT NULL,
+    type TEXT
+);
+CREATE TABLE IF NOT EXISTS files (
+    id TEXT PRIMARY KEY,
+    course_id TEXT NOT NULL REFERENCES courses(id),
+    parent_id TEXT REFERENCES files(id),
+    name TEXT NOT NULL,
+    author TEXT,
+    description TEXT,
+    size INTEGER,
+    created TEXT,
+    changed TEXT,
+    is_folder INTEGER NOT NULL,
+    is_single_child INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS courses_semester ON courses(semester_id);
+CREATE INDEX IF NOT EXISTS courses_name ON courses(name);
+CREATE INDEX IF NOT EXISTS files_course ON files(course_id);
+CREATE INDEX IF NOT EXISTS files_parent ON files(parent_id);
+CREATE INDEX IF NOT EXISTS files_name ON files(name);
+CREATE INDEX IF NOT EXISTS files_author ON files(author);
+CREATE INDEX IF NOT EXISTS files_changed ON files(changed);
+"""
+
+DESCENDANTS_QUERY = """
+WITH RECURSIVE descendants(id) AS (
+    SELECT id FROM files WHERE parent_id = ?
+    UNION ALL
+    SELECT files.id FROM files JOIN descendants ON files.parent_id = descendants.id
+)
+SELECT id FROM descendants
+"""
+
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def format_date(date: Optional[datetime]):
+    return date.strftime(DATE_FORMAT) if date else None
+
+
+def parse_date(date: Optional[str]):
+    return datetime.strptime(date, DATE_FORMAT) if date else None
+
+
+@attr.s(hash=False)
+class MetadataStore(object):
+    path = attr.ib()  # type: str
+
+    def __attrs_post_init__(self):
+        # identity maps, so that every record is only rebuilt once and parents are shared between their children
+        self._semesters = {}  # type: Dict[str, Semester]
+        self._courses = {}  # type: Dict[str, Course]
+        self._files = {}  # type: Dict[str, File]
+
+    @cached_property
+    def connection(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path)
+        connection.row_factory = sqlite3.Row
+        connection.executescript(SCHEMA)
+        return connection
+
+    def close(self):
+        if "connection" in self.__dict__:
+            self.connection.close()
+            del self.__dict__["connection"]
+
+    # storing records from the parsers
+
+    def store_semesters(self, semesters: Iterable[Semester]):
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO semesters (id, name, "order") VALUES (?, ?, ?)',
+                ((s.id, s.name, s.order) for s in semesters))
+
+    def store_courses(self, courses: Iterable[Course]):
+        courses = list(courses)
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO semesters (id, name, "order") VALUES (?, ?, ?)',
+                ((c.semester.id, c.semester.name, c.semester.order) for c in courses))
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO courses (id, semester_id, number, name, type) VALUES (?, ?, ?, ?, ?)",
+                ((c.id, c.semester.id, c.number, c.name, c.type) for c in courses))
+
+    def store_folder(self, folder: Folder):
+        # stores the folder together with all loaded (sub-)contents, replacing previously stored contents
+        self.store_courses([folder.course])
+        files = [folder]
+        removed = []
+        parents = []
+        parent = folder.parent
+        while isinstance(parent, File):
+            parents.append(parent)
+            parent = parent.parent
+        with self.connection:
+            # keep already stored parents untouched, but make sure the folder is reachable from its course's root
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO files (id, course_id, parent_id, name, author, description, size, created, "
+                "changed, is_folder, is_single_child) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (self._file_values(f) for f in parents))
+            for f in files:
+                if f.is_folder() and f.contents is not None:
+                    files.extend(f.contents)
+                    removed.extend(self._removed_children(f))
+            for fid in list(removed):
+                removed.extend(row["id"] for row in self.connection.execute(DESCENDANTS_QUERY, (fid,)))
+            self.connection.executemany("DELETE FROM files WHERE id = ?", ((fid,) for fid in removed))
+            for fid in removed:
+                self._files.pop(fid, None)
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO files (id, course_id, parent_id, name, author, description, size, created, "
+                "changed, is_folder, is_single_child) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (self._file_values(f) for f in files))
+        log.debug("Stored %s files of folder %s, removed %s", len(files), folder, len(removed))
+
+    @staticmethod
+    def _file_values(f: File):
+        parent_id = f.parent.id if isinstance(f.parent, File) else f.parent
+        return (f.id, f.course.id, parent_id, f.name, f.author, f.description, f.size,
+                format_date(f.created), format_date(f.changed), f.is_folder(), f.is_single_child)
+
+    def _removed_children(self, folder: Folder):
+        ids = set(f.id for f in folder.contents)
+        rows = self.connection.execute("SELECT id FROM files WHERE parent_id = ?", (folder.id,))
+        return [row["id"] for row in rows if row["id"] not in ids]
+
+    # querying and rebuilding model objects
+
+    def get_semesters(self) -> List[Semester]:
+        rows = self.connection.execute('SELECT * FROM semesters ORDER BY "order" DESC')
+        return [self._semester(row) for row in rows]
+
+    def get_courses(self, semester: Semester = None) -> List[Course]:
+        if semester:
+            rows = self.connection.execute("SELECT * FROM courses WHERE semester_id = ?", (semester.id,))
+        else:
+            rows = self.connection.execute("SELECT * FROM courses")
+        return [self._course(row) for row in rows]
+
+    def get_course_files(self, course: Course) -> Optional[Folder]:
+        # loads the whole file tree of the course at once
+        rows = self.connection.execute("SELECT * FROM files WHERE course_id = ?", (course.id,)).fetchall()
+        files = [self._file(row) for row in rows]
+        for f in files:
+            if f.is_folder():
+                f.contents = []
+        for f in files:
+            if f.parent:
+                f.parent.contents.append(f)
+        return next((f for f in files if f.is_folder() and f.is_root), None)
+
+    def get_folder_files(self, folder: Folder) -> Folder:
+        rows = self.connection.execute("SELECT * FROM files WHERE parent_id = ?", (folder.id,))
+        folder.contents = [self._file(row) for row in rows]
+        return folder
+
+    def find_files(self, name: str = None, author: str = None, changed_after: datetime = None,
+                   changed_before: datetime = None, course: Course = None, folders: bool = False) -> List[File]:
+        # name is a SQL LIKE pattern, e.g. "%.pdf"
+        clauses, args = ["is_folder = ?"], [folders]
+        if name is not None:
+            clauses.append("name LIKE ?")
+            args.append(name)
+        if author is not None:
+            clauses.append("author = ?")
+            args.append(author)
+        if changed_after is not None:
+            clauses.append("changed >= ?")
+            args.append(format_date(changed_after))
+        if changed_before is not None:
+            clauses.append("changed < ?")
+            args.append(format_date(changed_before))
+        if course is not None:
+            clauses.append("course_id = ?")
+            args.append(course.id)
+        rows = self.connection.execute(
+            "SELECT * FROM files WHERE %s ORDER BY changed DESC" % " AND ".join(clauses), args)
+        return [self._file(row) for row in rows]
+
+    # cached objects are updated in place from every row read, so that they reflect later calls to store_*
+
+    def _semester(self, row) -> Semester:
+        semester = self._semesters.get(row["id"])
+        if not semester:
+            semester = self._semesters[row["id"]] = Semester(id=row["id"], name=row["name"])
+        semester.name = row["name"]
+        semester.order = row["order"]
+        return semester
+
+    def _course(self, row) -> Course:
+        course = self._courses.get(row["id"])
+        if not course or course.semester.id != row["semester_id"]:
+            semester = self._semester(self.connection.execute(
+                "SELECT * FROM semesters WHERE id = ?", (row["semester_id"],)).fetchone())
+            if not course:
+                course = self._courses[row["id"]] = Course(id=row["id"], semester=semester, number=row["number"],
+                                                           name=row["name"], type=row["type"])
+            course.semester = semester
+        course.number = row["number"]
+        course.name = row["name"]
+        course.type = row["type"]
+        return course
+
+    def _file(self, row) -> File:
+        file = self._files.get(row["id"])
+        if file and file.is_folder() != bool(row["is_folder"]):
+            file = None
+        if not file or file.course.id != row["course_id"]:
+            course = self._course(self.connection.execute(
+                "SELECT * FROM courses WHERE id = ?", (row["course_id"],)).fetchone())
+            if not file:
+                file = self._files[row["id"]] = (Folder if row["is_folder"] else File)(
+                    id=row["id"], course=course, parent=None, name=row["name"])
+            file.course = course
+        if (file.parent.id if file.parent else None) != row["parent_id"]:
+            file.parent = self._files.get(row["parent_id"]) if row["parent_id"] else None
+            if row["parent_id"] and not file.parent:
+                parent_row = self.connection.execute(
+                    "SELECT * FROM files WHERE id = ?", (row["parent_id"],)).fetchone()
+                # a parent that was never stored is treated like a root folder
+                file.parent = self._file(parent_row) if parent_row else None
+        file.name = row["name"]
+        file.author = row["author"]
+        file.description = row["description"]
+        file.size = row["size"]
+        file.created = parse_date(row["created"])
+        file.changed = parse_date(row["changed"])
+        file.is_single_child = bool(row["is_single_child"])
+        return file
@@ -0,0 +1,184 @@
+import asyncio
+import collections
+import heapq
+import itertools
+import logging
+from datetime import datetime
+from typing import Deque, Dict, List, Optional
+
+import attr
+
+from studip_api.model import File, Folder
+from studip_api.session import StudIPSession
+
+log = logging.getLogger("studip_api.FolderWatcher")
+
+ADDED = "added"
+CHANGED = "changed"
+REMOVED = "removed"
+
+
+@attr.s(hash=False)
+class FileEvent(object):
+    kind = attr.ib()  # type: str
+    file = attr.ib()  # type: File
+    old_file = attr.ib(default=None)  # type: File
+
+    def __str__(self):
+        return "%s %s" % (self.kind, self.file)
+
+
+@attr.s(hash=False)
+class WatchedFolder(object):
+    folder = attr.ib()  # type: Folder
+    interval = attr.ib()  # type: float
+    next_refresh = attr.ib(default=0)  # type: float
+    known = attr.ib(default=None)  # type: Dict[str, File]
+    history = attr.ib(default=attr.Factory(lambda: collections.deque(maxlen=16)))  # type: Deque[datetime]
+    removed = attr.ib(default=False)  # type: bool
+
+    def __hash__(self):
+        return hash(self.folder.id)
+
+    @property
+    def last_change(self) -> Optional[datetime]:
+        return self.history[-1] if self.history else None
+
+
+@attr.s(hash=False)
+class FolderWatcher(object):
+    session = attr.ib()  # type: StudIPSession
+    folders = attr.ib()  # type: List[Folder]
+    requests_per_minute = attr.ib(default=30)  # type: float
+    min_interval = attr.ib(default=60)  # type: float
+    max_interval = attr.ib(default=7 * 24 * 60 * 60)  # type: float
+    backoff = attr.ib(default=2)  # type: float
+
+    # noinspection PyProtectedMember
+    def __attrs_post_init__(self):
+        self._loop = self.session._loop  # type: asyncio.AbstractEventLoop
+        self._watched = {}  # type: Dict[str, WatchedFolder]
+        self._schedule = []  # type: List
+        self._counter = itertools.count()
+        self._pending = collections.deque()  # type: Deque[FileEvent]
+        self._last_request = None  # type: float
+        for folder in self.folders:
+            self.watch(folder)
+
+    def watch(self, folder: Folder, known: Dict[str, File] = None):
+        # pass known={} for new folders, so that their first listing reports all contents as added
+        if folder.id in self._watched:
+            return self._watched[folder.id]
+        if known is None and folder.contents is not None:
+            known = {f.id: f for f in folder.contents}
+        watched = WatchedFolder(folder=folder, interval=self.min_interval, known=known)
+        if known:
+            watched.history.extend(sorted(f.changed for f in known.values() if f.changed))
+            watched.interval = self._initial_interval(watched)
+            watched.next_refresh = self._loop.time() + watched.interval
+            for f in known.values():
+                if f.is_folder():
+                    self.watch(f)
+        self._watched[folder.id] = watched
+        self._enqueue(watched)
+        return watched
+
+    def unwatch(self, folder: Folder):
+        watched = self._watched.pop(folder.id, None)
+        if watched:
+            watched.removed = True
+            for f in (watched.known or {}).values():
+                if f.is_folder():
+                    self.unwatch(f)
+
+    @property
+    def watched(self) -> List[WatchedFolder]:
+        return list(self._watched.values())
+
+    def _initial_interval(self, watched: WatchedFolder):
+        # a folder that hasn't changed for n days is assumed to stay unchanged for about another n/10 days
+        if not watched.last_change:
+            return self.max_interval
+        age = (datetime.now() - watched.last_change).total_seconds()
+        return min(self.max_interval, max(self.min_interval, age / 10))
+
+    def _enqueue(self, watched: WatchedFolder):
+        heapq.heappush(self._schedule, (watched.next_refresh, next(self._counter), watched))
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> FileEvent:
+        while not self._pending:
+            if not self._schedule:
+                raise StopAsyncIteration()
+            await self._refresh_next()
+        return self._pending.popleft()
+
+    async def _refresh_next(self):
+        next_refresh, _, watched = heapq.heappop(self._schedule)
+        if watched.removed:
+            return
+
+        now = self._loop.time()
+        start = next_refresh
+        if self._last_request is not None:
+            start = max(start, self._last_request + 60 / self.requests_per_minute)
+        if start > now:
+            await asyncio.sleep(start - now)
+        self._last_request = self._loop.time()
+
+        try:
+            events = await self._refresh(watched)
+        except asyncio.CancelledError:
+            self._enqueue(watched)
+            raise
+        except Exception:
+            log.warning("Could not refresh folder %s, backing off", watched.folder, exc_info=True)
+            events = []
+
+        if events is None:
+            watched.interval = self._initial_interval(watched)
+            events = []
+        elif events:
+            watched.interval = max(self.min_interval, watched.interval / self.backoff)
+        else:
+            watched.interval = min(self.max_interval, watched.interval * self.backoff)
+        watched.next_refresh = self._loop.time() + watched.interval
+        log.debug("Refreshed folder %s with %s changes, next refresh in %ss",
+                  watched.folder, len(events), watched.interval)
+        if not watched.removed:
+            self._enqueue(watched)
+        self._pending.extend(events)
+
+    async def _refresh(self, watched: WatchedFolder) -> Optional[List[FileEvent]]:
+        folder = await self.session.get_folder_files(watched.folder)
+        current = {f.id: f for f in folder.contents}
+        old = watched.known
+        watched.known = current
+
+        if old is None:
+            # first listing of this folder only serves as baseline
+            watched.history.extend(sorted(f.changed for f in current.values() if f.changed))
+            for f in current.values():
+                if f.is_folder():
+                    self.watch(f)
+            return None
+
+        events = []
+        for fid, f in current.items():
+            if fid not in old:
+                events.append(FileEvent(ADDED, f))
+                if f.is_folder():
+                    self.watch(f, known={})
+            elif f.changed != old[fid].changed or f.size != old[fid].size or f.name != old[fid].name:
+                events.append(FileEvent(CHANGED, f, old[fid]))
+        for fid, f in old.items():
+            if fid not in current:
+                events.append(FileEvent(REMOVED, f))
+                if f.is_folder():
+                    self.unwatch(f)
+
+        for e in events:
+            watched.history.append(e.file.changed if e.kind != REMOVED and e.file.changed else datetime.now())
+        return events
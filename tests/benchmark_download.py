@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# Compares the adaptive range sizing of Download against fixed 256 KiB ranges that are all requested at once,
+# using a local aiohttp server that adds a fixed latency to every request.
+#
+#     python tests/benchmark_download.py [--latency 0.05] [--port 8089]
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+import aiohttp
+from aiohttp import web
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from studip_api.downloader import Download  # noqa: E402
+
+FILES = {"small": 20 * 1024, "medium": 5 * 1024 * 1024, "large": 64 * 1024 * 1024}
+FIXED_CHUNK_SIZE = 1024 * 256
+
+
+class FixedSizeDownload(Download):
+    # the behaviour before adaptive range sizing: a HEAD request and all fixed-size ranges started at once
+
+    async def start(self):
+        self.total_length = await self.fetch_total_length()
+        self.parallel = max(1, -(-self.total_length // self.chunk_size))
+        self.size = self.total_length
+        await super().start()
+
+    def _next_range_size(self):
+        return self.chunk_size
+
+
+async def run(label, factory, url, tmp_dir, counter):
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=8)) as ahttp:
+        for name, size in FILES.items():
+            counter[0] = 0
+            local_path = os.path.join(tmp_dir, "dst_" + name)
+            download = factory(ahttp, url + name, local_path, size)
+            start = time.perf_counter()
+            await download.start()
+            await download.completed
+            duration = time.perf_counter() - start
+            with open(local_path, "rb") as dst, open(os.path.join(tmp_dir, "src_" + name), "rb") as src:
+                assert dst.read() == src.read(), "Downloaded %s differs from source" % name
+            print("%-26s %-7s %8.3fs %5d requests" % (label, name, duration, counter[0]))
+
+
+async def main(latency, port):
+    counter = [0]
+
+    @web.middleware
+    async def add_latency(request, handler):
+        counter[0] += 1
+        await asyncio.sleep(latency)
+        return await handler(request)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, size in FILES.items():
+            with open(os.path.join(tmp_dir, "src_" + name), "wb") as f:
+                f.write(os.urandom(size))
+
+        async def serve(request):
+            return web.FileResponse(os.path.join(tmp_dir, "src_" + request.match_info["name"]))
+
+        app = web.Application(middlewares=[add_latency])
+        app.router.add_route("*", "/{name}", serve)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        url = "http://127.0.0.1:%s/" % port
+        try:
+            await run("fixed 256 KiB ranges", lambda a, u, p, s: FixedSizeDownload(a, u, p, FIXED_CHUNK_SIZE),
+                      url, tmp_dir, counter)
+            await run("adaptive, size known", lambda a, u, p, s: Download(a, u, p, size=s), url, tmp_dir, counter)
+            await run("adaptive, HEAD request", lambda a, u, p, s: Download(a, u, p), url, tmp_dir, counter)
+        finally:
+            await runner.cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds added to every request")
+    parser.add_argument("--port", type=int, default=8089)
+    args = parser.parse_args()
+    asyncio.get_event_loop().run_until_complete(main(args.latency, args.port))
@@ -0,0 +1,44 @@
+import os
+import subprocess
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+# cumulative import time of studip_api.session in microseconds, most of which is spent importing asyncio
+IMPORT_TIME_BUDGET = 200000
+HEAVY_MODULES = ["bs4", "lxml", "aiohttp", "aiofiles"]
+
+
+def import_time(module):
+    output = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import sys, %s; print(' '.join(sys.modules))" % module],
+        cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    cumulative = {}
+    for line in output.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative_us, name = line.split("|")
+        if cumulative_us.strip().isdigit():
+            cumulative[name.strip()] = int(cumulative_us)
+    return cumulative, output.stdout.split()
+
+
+class ImportTimeTest(unittest.TestCase):
+    def test_package_import_loads_no_submodules(self):
+        _, modules = import_time("studip_api")
+        self.assertEqual([m for m in modules if m.startswith("studip_api.")], [])
+
+    def test_session_import_defers_heavy_modules(self):
+        _, modules = import_time("studip_api.session")
+        self.assertEqual([m for m in HEAVY_MODULES if m in modules], [])
+
+    def test_session_import_time_budget(self):
+        # take the best of several runs to reduce noise from the machine
+        times = [import_time("studip_api.session")[0]["studip_api.session"] for _ in range(5)]
+        self.assertLess(min(times), IMPORT_TIME_BUDGET,
+                        "Importing studip_api.session took %sus, budget is %sus" % (min(times), IMPORT_TIME_BUDGET))
+
+
+if __name__ == "__main__":
+    unittest.main()